@@ -3,10 +3,16 @@
 import os
 import json
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 from bids_validator import BIDSValidator
 
+try:
+    from orjson import loads as _orjson_loads
+except ImportError:
+    _orjson_loads = None
+
 import bids.config
 from ..utils import listify, make_bidsfile
 from ..exceptions import BIDSConflictingValuesError
@@ -15,17 +21,68 @@ from .models import Config, Entity, Tag, FileAssociation
 from .validation import validate_indexing_args
 
 
+def _get_entity_matchers(entities):
+    """Precompute the per-Entity state used to match entities against paths.
+
+    Returns a list of (entity, name, bound regex search method, mandatory,
+    dtype, dtype name) tuples, so that matching many files avoids repeated
+    attribute lookups. Entities without a pattern can never match, so they
+    are resolved here rather than per file: optional ones are dropped, and
+    a mandatory one ends the list, since matching stops at a mandatory
+    entity that fails to match.
+
+    Patterns are deliberately searched one at a time. They run against the
+    full path and can match overlapping spans (e.g., suffix and extension),
+    so they can't be merged into a single alternation, and merging them as
+    a chain of optional lookaheads turns out slower than separate searches.
+    """
+    matchers = []
+    for e in entities.values():
+        if e.regex is None:
+            if e.mandatory:
+                break
+            continue
+        matchers.append(
+            (e, e.name, e.regex.search, e.mandatory, e.dtype, e._dtype))
+    return matchers
+
+
 def _extract_entities(bidsfile, entities):
     match_vals = {}
-    for e in entities.values():
-        m = e.match_file(bidsfile)
-        if m is None and e.mandatory:
-            break
-        if m is not None:
-            match_vals[e.name] = (e, m)
+    for e, name, search, mandatory, dtype, _ in _get_entity_matchers(entities):
+        m = search(bidsfile.path)
+        val = m.group(1) if m is not None else None
+        if val is None:
+            if mandatory:
+                break
+            continue
+        match_vals[name] = (e, dtype(val))
     return match_vals
 
 
+def _load_json_sidecar(path):
+    """Load and return the contents of a JSON sidecar file.
+
+    Uses orjson, which is considerably faster, if it is installed.
+    """
+    if _orjson_loads is not None:
+        with open(path, 'rb') as handle:
+            try:
+                return _orjson_loads(handle.read())
+            except ValueError:
+                # orjson is stricter than the json module (e.g., it rejects
+                # NaN and non-UTF-8 text), so defer to json for such files.
+                pass
+
+    with open(path, 'r') as handle:
+        try:
+            return json.load(handle)
+        except json.JSONDecodeError as e:
+            msg = ("Error occurred while trying to decode JSON"
+                   " from file '{}'.".format(path))
+            raise IOError(msg) from e
+
+
 def _check_path_matches_patterns(path, patterns):
     """Check if the path matches at least one of the provided patterns. """
     if not patterns:
@@ -147,80 +204,134 @@ class BIDSLayoutIndexer:
 
     def _index_dir(self, path, config, default_action=None):
 
-        abs_path = os.path.join(self._layout.root, path)
-
-        # Derivative directories must always be added separately
-        # and passed as their own root, so terminate if passed.
-        if abs_path.startswith(os.path.join(self._layout.root, 'derivatives')):
-            return
-
-        config = list(config)  # Shallow copy
-
-        # Check for additional config file in directory
-        layout_file = self.config_filename
-        config_file = os.path.join(abs_path, layout_file)
-        if os.path.exists(config_file):
-            cfg = Config.load(config_file, session=self.session)
-            config.append(cfg)
+        root = self._layout.root
+        derivatives_root = os.path.join(root, 'derivatives')
 
-        # Track which entities are valid in filenames for this directory
+        # Track which entities are valid in filenames
         config_entities = {}
         for c in config:
             config_entities.update(c.entities)
 
-        for (dirpath, dirnames, filenames) in os.walk(path):
+        # Walk the tree iteratively rather than recursively. Each stack item
+        # holds a directory along with the entities (and their matchers) and
+        # the default inclusion/exclusion directive inherited from its
+        # parent. These are never mutated, so children share them unless a
+        # directory brings its own config file.
+        stack = [(path, config_entities,
+                  _get_entity_matchers(config_entities), default_action)]
 
-            # Set the default inclusion/exclusion directive
-            default = self._validate_dir(dirpath, default=default_action)
+        # New files and tags are buffered and written with bulk inserts,
+        # rather than being tracked one by one by the session.
+        files, tags = [], []
 
-            # If layout configuration file exists, delete it
-            if self.config_filename in filenames:
-                filenames.remove(self.config_filename)
+        while stack:
+            (path, config_entities, entity_matchers,
+             default_action) = stack.pop()
 
-            for f in filenames:
+            abs_path = os.path.join(root, path)
 
-                bf = self._index_file(f, dirpath, config_entities,
-                                      default_action=default)
-                if bf is None:
-                    continue
+            # Derivative directories must always be added separately
+            # and passed as their own root, so skip if encountered.
+            if abs_path.startswith(derivatives_root):
+                continue
 
-            self.session.commit()
+            # Unreadable directories are skipped, as os.walk() would do.
+            # Exhausting the iterator closes it (no context manager on 3.5).
+            try:
+                entries = list(os.scandir(path))
+            except OSError:
+                continue
 
-            # Recursively index subdirectories
-            for d in dirnames:
-                d = os.path.join(dirpath, d)
-                self._index_dir(d, list(config), default_action=default)
+            # Split the listing into files and subdirectories. DirEntry
+            # caches the file type from the directory read, so this
+            # normally needs no extra stat calls.
+            subdirs, dir_files = [], []
+            for entry in entries:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                (subdirs if is_dir else dir_files).append(entry)
+
+            # Check for additional config file in directory, using the
+            # listing we already have rather than stat-ing the path.
+            layout_file = self.config_filename
+            config_file = None
+            for entry in dir_files:
+                if entry.name == layout_file:
+                    config_file = entry.path
+                    break
+            if config_file is not None:
+                cfg = Config.load(config_file, session=self.session)
+                config_entities = dict(config_entities, **cfg.entities)
+                entity_matchers = _get_entity_matchers(config_entities)
 
-            # Prevent subdirectory traversal
-            break
+            # Set the default inclusion/exclusion directive
+            default = self._validate_dir(path, default=default_action)
 
-    def _index_file(self, f, dirpath, entities, default_action=None):
-        """Create DB record for file and its tags. """
-        abs_fn = os.path.join(dirpath, f)
+            for entry in dir_files:
+                # If layout configuration file exists, skip it
+                if entry.name == layout_file:
+                    continue
+                indexed = self._index_file(entry.path, entity_matchers,
+                                           default_action=default)
+                if indexed is None:
+                    continue
+                bf, bf_tags = indexed
+                files.append(bf)
+                tags.extend(bf_tags)
+
+            if len(files) + len(tags) >= 5000:
+                self._save_files(files, tags)
+
+            # Queue subdirectories, preserving their listing order
+            for entry in reversed(subdirs):
+                stack.append((entry.path, config_entities, entity_matchers,
+                              default))
+
+        self._save_files(files, tags)
+
+    def _save_files(self, files, tags):
+        """Bulk insert buffered BIDSFiles and tag rows, then clear the
+        buffers. """
+        # Group files by class so that each polymorphic type is inserted
+        # in a single batch.
+        files.sort(key=lambda bf: bf.class_)
+        self.session.bulk_save_objects(files)
+        if tags:
+            self.session.execute(Tag.__table__.insert(), tags)
+        self.session.commit()
+        files.clear()
+        tags.clear()
+
+    def _index_file(self, abs_fn, entity_matchers, default_action=None):
+        """Create a BIDSFile and its tags, returned as a (file, tags) tuple.
 
+        Tags are returned as rows for the tags table rather than Tag objects,
+        so they can be inserted in bulk without ORM overhead. Returns None if
+        the file fails validation. The caller is responsible for adding the
+        returned records to the DB.
+        """
         # Skip files that fail validation, unless forcibly indexing
         if not self._validate_file(abs_fn, default=default_action):
             return None
 
         bf = make_bidsfile(abs_fn)
-        self.session.add(bf)
-
-        # Extract entity values
-        match_vals = {}
-        for e in entities.values():
-            m = e.match_file(bf)
-            if m is None and e.mandatory:
-                break
-            if m is not None:
-                match_vals[e.name] = (e, m)
-
-        # Create Entity <=> BIDSFile mappings
-        if match_vals:
-            for _, (ent, val) in match_vals.items():
-                tag = Tag(bf, ent, str(val), ent._dtype)
-                self.session.add(tag)
+        tags = []
+
+        # Extract entity values and create Entity <=> BIDSFile mappings.
+        # This inlines Entity.match_file() using the precomputed matchers.
+        for _, name, search, mandatory, dtype, dtype_name in entity_matchers:
+            m = search(abs_fn)
+            val = m.group(1) if m is not None else None
+            if val is None:
+                if mandatory:
+                    break
+                continue
+            tags.append({'file_path': abs_fn, 'entity_name': name,
+                         '_value': str(dtype(val)), '_dtype': dtype_name})
 
-        return bf
+        return bf, tags
 
     def _index_metadata(self):
         """Index metadata for all files in the BIDS dataset.
@@ -242,9 +353,6 @@ class BIDSLayoutIndexer:
                 if json_ext not in filters[ext_key]:
                     filters[ext_key].append(json_ext)
 
-        # Process JSON files first if we're indexing metadata
-        all_files = self._layout.get(absolute_paths=True, **filters)
-
         # Track ALL entities we've seen in file names or metadatas
         all_entities = {}
         for c in self._config:
@@ -256,63 +364,123 @@ class BIDSLayoutIndexer:
         # that before adding each new Tag.
         all_tags = {}
         for t in self.session.query(Tag).all():
-            key = '{}_{}'.format(t.file_path, t.entity_name)
-            all_tags[key] = str(t.value)
+            all_tags[(t.file_path, t.entity_name)] = str(t.value)
 
         # We build up a store of all file data as we iterate files. It looks
-        # like: { extension/suffix: dirname: [(entities, payload)]}}.
-        # The payload is left empty for non-JSON files.
+        # like: { (extension, suffix): dirname: entity names: [(order,
+        # entity items, payload, path)]}}}.
+        # Grouping by the set of entity names means that only groups whose
+        # entities the current file also has need to be checked. Entities
+        # are stored as a frozenset of (name, value) pairs, so that matching
+        # against another file is a single subset test. The payload is left
+        # empty for non-JSON files.
         file_data = {}
 
-        for bf in all_files:
-            file_ents = bf.entities.copy()
-            suffix = file_ents.pop('suffix', None)
-            ext = file_ents.pop('extension', None)
+        # Entities (minus suffix and extension) are read once per file. The
+        # non-JSON files are collected along with them, as they're the ones
+        # we look up metadata for in the second pass below. The result of
+        # get() isn't kept around, so other files can be released after this
+        # pass.
+        non_json_files = []
+
+        to_store = []
+        json_paths = []
+        for bf in self._layout.get(absolute_paths=True, **filters):
+            ents = bf.entities
+            suffix = ents.get('suffix')
+            ext = ents.get('extension')
+            file_ents = {name: val for name, val in ents.items()
+                         if name not in ('suffix', 'extension')}
 
             if suffix is not None and ext is not None:
-                key = "{}/{}".format(ext, suffix)
+                # Frozen views of the entities, used for matching files
+                # against each other in both passes
+                file_items = frozenset(file_ents.items())
+                file_keys = frozenset(file_ents)
+
+                if not bf.path.endswith('.json'):
+                    non_json_files.append(
+                        (bf, file_ents, file_items, file_keys, suffix, ext))
+
+                key = (ext, suffix)
                 if key not in file_data:
-                    file_data[key] = defaultdict(list)
+                    file_data[key] = defaultdict(dict)
 
                 if ext == dot + 'json':
-                    with open(bf.path, 'r') as handle:
-                        try:
-                            payload = json.load(handle)
-                        except json.JSONDecodeError as e:
-                            msg = ("Error occurred while trying to decode JSON"
-                                   " from file '{}'.".format(bf.path))
-                            raise IOError(msg) from e
+                    json_paths.append(bf.path)
+
+                to_store.append(
+                    (key, bf.dirname, file_items, file_keys, bf.path))
+
+        # Read JSON sidecars concurrently; file I/O and parsing are
+        # independent per file. All DB access stays in this thread.
+        with ThreadPoolExecutor() as executor:
+            payloads = dict(zip(json_paths,
+                                executor.map(_load_json_sidecar, json_paths)))
+
+        for order, entry in enumerate(to_store):
+            key, dirname, file_items, file_keys, path = entry
+            payload = payloads.get(path)
+            groups = file_data[key][dirname]
+            groups.setdefault(file_keys, []).append(
+                (order, file_items, payload, path))
+
+        def find_matches(groups, file_items, file_keys):
+            """Return the stored entries whose entities are all matched by
+            the file's, in the order the entries were stored."""
+            matches = []
+            for keys, entries in groups.items():
+                if keys <= file_keys:
+                    matches.extend(e for e in entries if e[1] <= file_items)
+            if len(matches) > 1:
+                matches.sort()
+            return matches
+
+        # Cache the chain of ancestor directories (nearest first), since
+        # many files share the same directory. Each chain extends its
+        # parent's cached chain, so every directory is only resolved once.
+        ancestor_chains = {}
+
+        def get_ancestors(dirname):
+            chain = ancestor_chains.get(dirname)
+            if chain is None:
+                parent = os.path.dirname(dirname)
+                if parent == dirname:
+                    chain = (dirname,)
                 else:
-                    payload = None
+                    chain = (dirname,) + get_ancestors(parent)
+                ancestor_chains[dirname] = chain
+            return chain
 
-                to_store = (file_ents, payload, bf.path)
-                file_data[key][bf.dirname].append(to_store)
-
-        # To avoid integrity errors, track primary keys we've seen
+        # Associations are buffered as rows and written with bulk inserts.
+        # To avoid integrity errors, track primary keys we've seen.
+        assoc_rows = []
         seen_assocs = set()
 
         def create_association_pair(src, dst, kind, kind2=None):
             kind2 = kind2 or kind
-            pk1 = '#'.join([src, dst, kind])
-            if pk1 not in seen_assocs:
-                self.session.add(FileAssociation(src=src, dst=dst, kind=kind))
-                seen_assocs.add(pk1)
-            pk2 = '#'.join([dst, src, kind2])
-            if pk2 not in seen_assocs:
-                self.session.add(FileAssociation(src=dst, dst=src, kind=kind2))
-                seen_assocs.add(pk2)
+            for pk in ((src, dst, kind), (dst, src, kind2)):
+                if pk not in seen_assocs:
+                    seen_assocs.add(pk)
+                    assoc_rows.append(
+                        {'src': pk[0], 'dst': pk[1], 'kind': pk[2]})
+
+        # Metadata tags are buffered and written with bulk inserts
+        md_tags = []
+
+        def save_metadata():
+            """Bulk insert buffered tags and associations, then commit. """
+            self.session.bulk_save_objects(md_tags)
+            md_tags.clear()
+            if assoc_rows:
+                self.session.execute(FileAssociation.__table__.insert(),
+                                     assoc_rows)
+                assoc_rows.clear()
+            self.session.commit()
 
         # TODO: Efficiency of everything in this loop could be improved
-        filenames = [bf for bf in all_files if not bf.path.endswith('.json')]
-
-        for bf in filenames:
-            file_ents = bf.entities.copy()
-            suffix = file_ents.pop('suffix', None)
-            ext = file_ents.pop('extension', None)
-            file_ent_keys = set(file_ents.keys())
-
-            if suffix is None or ext is None:
-                continue
+        for entry in non_json_files:
+            bf, file_ents, file_items, file_keys, suffix, ext = entry
 
             # Extract metadata associated with the file. The idea is
             # that we loop over parent directories, and if we find
@@ -322,40 +490,27 @@ class BIDSLayoutIndexer:
             # the current file. If so, it's a valid candidate, and we
             # add the payload to the stack. Finally, we invert the
             # stack and merge the payloads in order.
-            ext_key = "{}/{}".format(ext, suffix)
-            json_key = dot + "json/{}".format(suffix)
-            dirname = bf.dirname
+            json_dirs = file_data.get((dot + 'json', suffix), {})
+            ext_dirs = file_data.get((ext, suffix), {})
 
             payloads = []
             ancestors = []
 
-            while True:
+            for dirname in get_ancestors(bf.dirname):
                 # Get JSON payloads
-                json_data = file_data.get(json_key, {}).get(dirname, [])
-                for js_ents, js_md, js_path in json_data:
-                    js_keys = set(js_ents.keys())
-                    if js_keys - file_ent_keys:
-                        continue
-                    matches = [js_ents[name] == file_ents[name]
-                               for name in js_keys]
-                    if all(matches):
+                json_data = json_dirs.get(dirname)
+                if json_data:
+                    for _, _, js_md, js_path in find_matches(
+                            json_data, file_items, file_keys):
                         payloads.append((js_md, js_path))
 
                 # Get all files this file inherits from
-                candidates = file_data.get(ext_key, {}).get(dirname, [])
-                for ents, _, path in candidates:
-                    keys = set(ents.keys())
-                    if keys - file_ent_keys:
-                        continue
-                    matches = [ents[name] == file_ents[name] for name in keys]
-                    if all(matches):
+                candidates = ext_dirs.get(dirname)
+                if candidates:
+                    for _, _, _, path in find_matches(
+                            candidates, file_items, file_keys):
                         ancestors.append(path)
 
-                parent = os.path.dirname(dirname)
-                if parent == dirname:
-                    break
-                dirname = parent
-
             if not payloads:
                 continue
 
@@ -384,11 +539,12 @@ class BIDSLayoutIndexer:
 
             # Files with IntendedFor field always get mapped to targets
             intended = listify(file_md.get('IntendedFor', []))
-            for target in intended:
+            if intended:
                 # Per spec, IntendedFor paths are relative to sub dir.
-                target = os.path.join(
-                    self._layout.root, 'sub-{}'.format(bf.entities['subject']),
-                    target)
+                sub_dir = os.path.join(
+                    self._layout.root, 'sub-' + str(file_ents['subject']))
+            for target in intended:
+                target = os.path.join(sub_dir, target)
                 create_association_pair(bf.path, target, 'IntendedFor',
                                         'InformedBy')
 
@@ -412,10 +568,10 @@ class BIDSLayoutIndexer:
 
             # Create Tag <-> Entity mappings, and any newly discovered Entities
             for md_key, md_val in file_md.items():
-                tag_string = '{}_{}'.format(bf.path, md_key)
+                tag_key = (bf.path, md_key)
                 # Skip pairs that were already found in the filenames
-                if tag_string in all_tags:
-                    file_val = all_tags[tag_string]
+                if tag_key in all_tags:
+                    file_val = all_tags[tag_key]
                     if str(md_val) != file_val:
                         msg = (
                             "Conflicting values found for entity '{}' in "
@@ -429,10 +585,11 @@ class BIDSLayoutIndexer:
                 if md_key not in all_entities:
                     all_entities[md_key] = Entity(md_key, is_metadata=True)
                     self.session.add(all_entities[md_key])
-                tag = Tag(bf, all_entities[md_key], md_val)
-                self.session.add(tag)
+                md_tags.append(Tag(bf, all_entities[md_key], md_val))
 
-            if len(self.session.new) >= 1000:
-                self.session.commit()
+            # Commit based on the number of buffered rows, rather than
+            # inspecting the session's pending objects after every file.
+            if len(md_tags) + len(assoc_rows) >= 5000:
+                save_metadata()
 
-        self.session.commit()
+        save_metadata()
@@ -660,14 +660,11 @@ class BIDSLayout(object):
         if absolute_paths is None:  # can be overloaded as option to .get
             absolute_paths = self.absolute_paths
 
-        if not absolute_paths:
-            for i, fi in enumerate(results):
-                fi = copy.copy(fi)
-                fi.path = os.path.relpath(fi.path, self.root)
-                results[i] = fi
-
         if return_type.startswith('file'):
-            results = natural_sort([f.path for f in results])
+            results = [f.path for f in results]
+            if not absolute_paths:
+                results = [os.path.relpath(f, self.root) for f in results]
+            results = natural_sort(results)
 
         elif return_type in ['id', 'dir']:
             if target is None:
@@ -705,6 +702,14 @@ class BIDSLayout(object):
                 raise ValueError("Invalid return_type specified (must be one "
                                  "of 'tuple', 'filename', 'id', or 'dir'.")
         else:
+            # Only returned objects need relative paths. Paths are
+            # converted directly for filenames, and ids and dirs are
+            # computed from the original objects.
+            if not absolute_paths:
+                for i, fi in enumerate(results):
+                    fi = copy.copy(fi)
+                    fi.path = os.path.relpath(fi.path, self.root)
+                    results[i] = fi
             results = natural_sort(results, 'path')
 
         return results
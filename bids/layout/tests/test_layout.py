@@ -573,6 +573,20 @@ def test_indexed_file_associations(layout_7t_trt):
     assert not js.get_associations('InformedBy')
 
 
+def test_load_json_sidecar(tmp_path):
+    from bids.layout.index import _load_json_sidecar
+    sidecar = tmp_path / "sub-01_bold.json"
+    sidecar.write_text('{"RepetitionTime": 2.0, "SliceTiming": [0, 1]}')
+    assert _load_json_sidecar(str(sidecar)) == {
+        "RepetitionTime": 2.0, "SliceTiming": [0, 1]}
+    # Non-standard JSON that the json module tolerates still loads
+    sidecar.write_text('{"EchoTime": NaN}')
+    assert np.isnan(_load_json_sidecar(str(sidecar))["EchoTime"])
+    sidecar.write_text('{"RepetitionTime": 2.0,')
+    with pytest.raises(IOError, match="decode JSON"):
+        _load_json_sidecar(str(sidecar))
+
+
 def test_layout_save(tmp_path, layout_7t_trt):
     layout_7t_trt.save(str(tmp_path / "f.sqlite"),
                        replace_connection=False)